@@ -1,31 +1,42 @@
-import NonLinearPDESolver
-
-def computeGreeks(pde_solver     : NonLinearPDESolver,
-                  bump_for_delta : float = 0.01):
-    underlying = pde_solver.underlying
-    # Preserve previous state.
-    spot = underlying.getSpot()
-    # Compute the states.
-    spot_bump = bump_for_delta * spot
-    premium = pde_solver.solvePDE()
-    underlying.setSpot(spot - spot_bump)
-    premium_minus = pde_solver.solvePDE()
-    underlying.setSpot(spot + spot_bump)
-    premium_plus = pde_solver.solvePDE()
-    underlying.setSpot(spot)
-    if underlying.isNonLinear():
-        vol = underlying.getVol()
-        underlying.setVol(0.5 * (vol[0] + vol[1]))
-        premium_linear = pde_solver.solvePDE()
-        underlying.setVol(vol)
-    else:
-        premium_linear = premium
-    # Compute the Greeks by finite differences. (a.k.a bump-and-reprice)
-    delta = 100.0 * (premium_plus - premium_minus) / (2.0 * spot_bump)
-    gamma = 100.0 * (premium_plus - 2.0 * premium + premium_minus) / (spot_bump * spot_bump)
-    surprime = premium - premium_linear
-    # Return the Greeks (the order is important).
-    return premium, delta, gamma, surprime
-
-def getGreeksNames():
-    return ["Premium", "Delta", "Gamma", "Surprime"]
\ No newline at end of file
+import numpy as np
+import NonLinearPDESolver
+
+def computeGreeks(pde_solver     : NonLinearPDESolver,
+                  bump_for_delta : float = 0.01):
+    underlying = pde_solver.underlying
+    spot = underlying.getSpot()
+    spot_bump = bump_for_delta * spot
+    # For expired payoffs or breached continuous barriers, solvePDE returns the payoff directly :
+    # bump-and-reprice on the payoff itself.
+    continuous_barriers = pde_solver.payoff.getContinousBarriers()
+    if pde_solver.dT >= 0.0 or not (continuous_barriers[0] < spot < continuous_barriers[1]):
+        premium = pde_solver.solvePDE()
+        underlying.setSpot(spot - spot_bump)
+        premium_minus = pde_solver.solvePDE()
+        underlying.setSpot(spot + spot_bump)
+        premium_plus = pde_solver.solvePDE()
+        underlying.setSpot(spot)
+        premium_linear = premium
+    else:
+        # The backward sweep does not depend on the spot : roll back once and interpolate
+        # the terminal solution at the three spots instead of running three full sweeps.
+        solution = pde_solver._rollback()
+        premium_minus, premium, premium_plus = pde_solver._evaluate(
+            solution, np.array([spot - spot_bump, spot, spot + spot_bump]))
+        if underlying.isNonLinear():
+            # One extra (linear) sweep at mid-volatility for the surprime.
+            vol = underlying.getVol()
+            underlying.setVol(0.5 * (vol[0] + vol[1]))
+            premium_linear = pde_solver._evaluate(pde_solver._rollback(), spot)
+            underlying.setVol(vol)
+        else:
+            premium_linear = premium
+    # Compute the Greeks by finite differences. (a.k.a bump-and-reprice)
+    delta = 100.0 * (premium_plus - premium_minus) / (2.0 * spot_bump)
+    gamma = 100.0 * (premium_plus - 2.0 * premium + premium_minus) / (spot_bump * spot_bump)
+    surprime = premium - premium_linear
+    # Return the Greeks (the order is important).
+    return premium, delta, gamma, surprime
+
+def getGreeksNames():
+    return ["Premium", "Delta", "Gamma", "Surprime"]
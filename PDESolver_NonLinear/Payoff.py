@@ -1,23 +1,39 @@
 from abc import ABC, abstractmethod
 import numpy as np
 
+# Constraint kinds understood by the jitted rollback core (see getConstraintSpec).
+CONSTRAINT_NONE = 0      # no override of the solution
+CONSTRAINT_EXERCISE = 1  # solution <- max(solution, data)
+CONSTRAINT_PIN = 2       # data = [pin_low, value_low, pin_high, value_high]
+
 # Helper functions for Continuous Barriers (inclusive)
 def barrier(spot, barrier, is_down, is_out):
-    perf = (spot - barrier) * (-1.0 if is_down else 1.0)
-    ind = np.zeros(perf.shape)
-    ind[perf >= 0.0] = 1.0
-    return (1.0 - ind) if is_out else ind
+    sign = -1.0 if is_down else 1.0
+    breached = (sign * (spot - barrier)) >= 0.0
+    return (~breached if is_out else breached).astype(np.float64)
 
 # Base abstract class
 class Payoff(ABC):
     def __init__(self, args):
         self.t_expiry = args["Expiry"]
         self.notional = args.get("Notional", None)
+        self._args = args
+    # Rebuilds an identical payoff from its construction arguments.
+    # Much cheaper than a deepcopy, which traverses the whole object graph.
+    def clone(self):
+        return type(self)(self._args)
     # This function overrides the solution at every solving step:
     #   S(X, t) <- f(X, t, S(X, t))
     def getConstraint(self, S, t, solution):
         # By default, do nothing.
         return solution
+    # Numeric description of getConstraint for the jitted rollback core, as a
+    # (kind, data) pair using the CONSTRAINT_* kinds above. Returning a spec also asserts
+    # that getConstraint and getDirichletBoundaries do not depend on t. None (the default)
+    # means the payoff cannot be described numerically and the solver falls back to calling
+    # getConstraint step by step.
+    def getConstraintSpec(self, S):
+        return None
     # This function sets the payoff at expiry.
     @abstractmethod
     def getPayoff(self, S):
@@ -43,6 +59,8 @@ class AmericanCall(Payoff):
     def getConstraint(self, S, t, solution):
         exercise_value = np.maximum(S - self.strike, 0.0)
         return np.maximum(exercise_value, solution)
+    def getConstraintSpec(self, S):
+        return (CONSTRAINT_EXERCISE, np.maximum(S - self.strike, 0.0))
     def getPayoff(self, S):
         return np.maximum(S - self.strike, 0.0)
     def getDirichletBoundaries(self, S, t):
@@ -58,6 +76,9 @@ class UpAndOutCallSpread(Payoff):
         if S[-1] >= self.ko_barrier:
             solution[-1] = 0.0
         return solution
+    def getConstraintSpec(self, S):
+        return (CONSTRAINT_PIN,
+                np.array([0.0, 0.0, 1.0 if S[-1] >= self.ko_barrier else 0.0, 0.0]))
     def getPayoff(self, S):
         call = np.maximum(S - self.strike, 0.0)
         upper_call = np.maximum(S - self.upper_strike, 0.0)
@@ -78,6 +99,9 @@ class DownAndOutPut(Payoff):
         if S[0] <= self.ko_barrier:
             solution[0] = self.rebate
         return solution
+    def getConstraintSpec(self, S):
+        return (CONSTRAINT_PIN,
+                np.array([1.0 if S[0] <= self.ko_barrier else 0.0, self.rebate, 0.0, 0.0]))
     def getPayoff(self, S):
         put = np.maximum(self.strike - S, 0.0)
         ko_indicator = barrier(S, self.ko_barrier, is_down=True, is_out=True)
@@ -98,6 +122,10 @@ class DoubleNoTouch(Payoff):
         if S[-1] >= self.ko_barrier_up:
             solution[-1] = 0.0
         return solution
+    def getConstraintSpec(self, S):
+        return (CONSTRAINT_PIN,
+                np.array([1.0 if S[0] <= self.ko_barrier_down else 0.0, 0.0,
+                          1.0 if S[-1] >= self.ko_barrier_up else 0.0, 0.0]))
     def getPayoff(self, S):
         ko_indicator_down = barrier(S, self.ko_barrier_down, is_down=True, is_out=True)
         ko_indicator_up = barrier(S, self.ko_barrier_up, is_down=False, is_out=True)